@@ -1,6 +1,8 @@
-from flask import jsonify
+from flask import jsonify, request, current_app
 from flask_restful import Resource
 
+from tools import auth
+
 
 class API(Resource):
     def __init__(self, module):
@@ -8,11 +10,90 @@ class API(Resource):
 
     url_params = [
         '<string:mode>/<int:project_id>',
+        '<string:mode>',
     ]
 
-    def get(self, mode, project_id):
+    def get(self, mode, project_id=None):
+        """
+        Current permissions, with ETag. Query args:
+        since=<version> - only added/removed permissions since that version,
+            {version, full} (or compact body) if that version is unknown
+        encoding=compact - indices into registered permissions universe,
+        universe=<version> - skip universe if client has it
+        """
         current_permissions = self.module.resolve_permissions(
             mode=mode,
             project_id=project_id
         )
-        return jsonify(list(current_permissions))
+        version = self.module.remember_permissions_version(current_permissions)
+        #
+        since = request.args.get('since')
+        previous = self.module.permission_versions.get(since) if since else None
+        compact = request.args.get('encoding') == 'compact'
+        # ETag differs per representation
+        if previous is not None:
+            etag = f'{version}-since-{since}'
+        elif compact:
+            etag = f'{version}-compact-{self.module.get_permission_universe()[2]}'
+        elif since:
+            etag = f'{version}-full'
+        else:
+            etag = version
+        #
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+        #
+        if previous is not None:
+            response = jsonify({
+                'version': version,
+                'since': since,
+                'added': sorted(current_permissions - previous),
+                'removed': sorted(previous - current_permissions),
+            })
+        elif compact:
+            ordered, index, universe_version = self.module.get_permission_universe()
+            result = {
+                'version': version,
+                'universe_version': universe_version,
+                'indices': sorted(index[i] for i in current_permissions if i in index),
+                'extra': sorted(i for i in current_permissions if i not in index),
+            }
+            if request.args.get('universe') != universe_version:
+                result['universe'] = ordered
+            response = jsonify(result)
+        elif since:
+            response = jsonify({
+                'version': version,
+                'full': sorted(current_permissions),
+            })
+        else:
+            response = jsonify(list(current_permissions))
+        #
+        response.set_etag(etag)
+        return response
+
+    @auth.decorators.check_api({
+        "permissions": ["admin.users.permissions.view"],
+        "recommended_roles": {
+            "administration": {"admin": True, "viewer": False, "editor": False},
+            "default": {"admin": False, "viewer": False, "editor": False},
+            "developer": {"admin": False, "viewer": False, "editor": False},
+        }
+    }, mode="administration")
+    def post(self, mode, project_id=None):
+        """ Resolve permissions for a list of {user_id, project_id} pairs """
+        try:
+            pairs = [
+                (
+                    int(item['user_id']),
+                    None if item.get('project_id') is None else int(item['project_id']),
+                )
+                for item in request.json['pairs']
+            ]
+        except (KeyError, TypeError, ValueError):
+            return {'error': 'pairs must be a list of {"user_id", "project_id"}'}, 400
+        if len(pairs) > self.module.bulk_limit:
+            return {'error': f'pairs must have at most {self.module.bulk_limit} items'}, 400
+        return jsonify(self.module.resolve_permissions_bulk(pairs, mode=mode))
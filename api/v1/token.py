@@ -1,6 +1,7 @@
+import json
 from datetime import datetime, timedelta
 
-from flask import jsonify, request
+from flask import jsonify, request, Response, stream_with_context
 from pylon.core.tools import log
 
 from tools import auth, api_tools
@@ -23,6 +24,20 @@ class API(api_tools.APIBase):
                 return {'error': f'token with uid {uid} not found'}, 400
             token_data['token'] = auth.encode_token(token_data['id'])
             return jsonify(token_data)
+        if request.args.get('format') == 'ndjson':
+            return self._stream_tokens(auth.list_tokens(user['id']))
+        if 'cursor' in request.args or 'limit' in request.args:
+            try:
+                page = auth.list_page(
+                    'list_tokens', user['id'],
+                    cursor=request.args.get('cursor') or None,
+                    limit=max(1, min(int(request.args.get('limit', 100)), 1000)),
+                )
+            except ValueError as e:
+                return {'error': str(e)}, 400
+            for i in page['items']:
+                i['token'] = auth.encode_token(i['id'])
+            return jsonify(page)
         all_tokens = auth.list_tokens(user['id'])
 
         # log.warning('Token for user %s : %s', user, all_tokens)
@@ -37,32 +52,78 @@ class API(api_tools.APIBase):
             i['token'] = auth.encode_token(i['id'])
         return jsonify(all_tokens)
 
+    @staticmethod
+    def _stream_tokens(tokens: list) -> Response:
+        """ One JSON token per line, sent as encoded """
+        def _generate():
+            for i in tokens:
+                i['token'] = auth.encode_token(i['id'])
+                yield json.dumps(i, default=str) + '\n'
+        return Response(stream_with_context(_generate()), mimetype='application/x-ndjson')
+
     def post(self, **kwargs):
         user = self.module.current_user()
         if not user:
             return None, 403
+        if 'tokens' in request.json:
+            tokens = request.json['tokens']
+            limit = self.module.bulk_limit
+            if not isinstance(tokens, list) or len(tokens) > limit:
+                return {'error': f'tokens must be a list of at most {limit} items'}, 400
+            futures = [
+                self.module.bulk_executor.submit(self._create_token_item, user, data)
+                for data in tokens
+            ]
+            result = []
+            for future in futures:
+                token_data, error = future.result()
+                result.append(error or token_data)
+            return jsonify(result)
+
+        token_data, error = self._create_token(user, request.json)
+        if error:
+            return error, 400
+        return jsonify(token_data)
+
+    @classmethod
+    def _create_token_item(cls, user: dict, data: dict) -> tuple:
+        """ Bulk item: any failure becomes this item's error """
         try:
-            name = request.json['name']
-        except KeyError:
-            return {'error': 'Name is required'}, 400
+            return cls._create_token(user, data)
+        except Exception as e:  # pylint: disable=W0703
+            log.warning('Bulk token create failed: %s', e)
+            return None, {'error': str(e)}
 
-        expires = request.json.get('expires')
+    @staticmethod
+    def _create_token(user: dict, data: dict) -> tuple:
+        """ Create token from request data: (token_data, None) or (None, error) """
+        try:
+            name = data['name']
+        except (KeyError, TypeError):
+            return None, {'error': 'Name is required'}
+
+        expires = data.get('expires')
         if expires:
+            if not isinstance(expires, dict):
+                return None, {'error': 'expires must be an object'}
             allowed_measures = {'days', 'weeks', 'hours', 'minutes', 'seconds'}
             try:
                 assert expires['measure'] in allowed_measures
             except AssertionError:
-                return {'error': f'expires measure be in {allowed_measures}'}, 400
+                return None, {'error': f'expires measure be in {allowed_measures}'}
             except KeyError:
-                return {'error': f'expires must have "measure" key'}, 400
+                return None, {'error': f'expires must have "measure" key'}
 
             try:
                 expire_value = int(expires['value'])
-            except ValueError:
-                return {'error': f'expires must be int, got {type(expires)}'}, 400
+            except (ValueError, TypeError):
+                return None, {'error': f'expires must be int, got {type(expires)}'}
             except KeyError:
-                return {'error': f'expires must have "value" key'}, 400
-            expires = datetime.now() + timedelta(**{expires['measure']: expire_value})
+                return None, {'error': f'expires must have "value" key'}
+            try:
+                expires = datetime.now() + timedelta(**{expires['measure']: expire_value})
+            except OverflowError:
+                return None, {'error': 'expires value is out of range'}
 
         token_id = auth.add_token(
             user_id=user['id'],
@@ -71,18 +132,58 @@ class API(api_tools.APIBase):
         )
         token_data = auth.get_token(token_id=token_id)
         token_data['token'] = auth.encode_token(token_id)
-        return jsonify(token_data)
+        return token_data, None
 
-    def delete(self, uid: str, **kwargs):
+    def delete(self, uid: str | None = None, **kwargs):
         user = self.module.current_user()
         if not user:
             return None, 403
+        if uid is None:
+            limit = self.module.bulk_limit
+            try:
+                uids = request.json['uids']
+                assert isinstance(uids, list) and len(uids) <= limit
+                assert all(isinstance(i, str) for i in uids)
+            except (KeyError, TypeError, AssertionError):
+                return {'error': f'uids must be a list of at most {limit} strings'}, 400
+            futures = [
+                (i, self.module.bulk_executor.submit(self._revoke_token_item, user, i))
+                for i in uids
+            ]
+            revoked, errors = [], {}
+            for i, future in futures:
+                error = future.result()
+                if error:
+                    errors[i] = error
+                else:
+                    revoked.append(i)
+            return {'revoked': revoked, 'errors': errors}, 200
+
+        error = self._revoke_token(user, uid)
+        if error == 'forbidden':
+            return None, 403
+        if error:
+            return {'error': error}, 400
+        return None, 204
+
+    @classmethod
+    def _revoke_token_item(cls, user: dict, uid: str) -> str | None:
+        """ Bulk item: any failure becomes this item's error """
+        try:
+            return cls._revoke_token(user, uid)
+        except Exception as e:  # pylint: disable=W0703
+            log.warning('Bulk token revoke failed: %s', e)
+            return str(e)
+
+    @staticmethod
+    def _revoke_token(user: dict, uid: str) -> str | None:
+        """ Delete token owned by user, error message on failure """
         try:
             token_data = auth.get_token(uuid=uid)
         except RuntimeError:
-            return {'error': f'token with uid {uid} not found'}, 400
+            return f'token with uid {uid} not found'
         if token_data['user_id'] != user['id']:
-            return None, 403
+            return 'forbidden'
 
         auth.delete_token(token_id=token_data['id'])
-        return None, 204
+        return None
@@ -1,5 +1,6 @@
+import hashlib
 from queue import Empty
-from flask import g, request, jsonify
+from flask import g, request, current_app
 from pylon.core.tools import log
 
 from tools import api_tools, auth, config as c
@@ -16,16 +17,49 @@ class API(api_tools.APIBase):
     # }
 
     def get(self, **kwargs):
-        user = self.module.current_user()
+        auth_data = g.auth
+        cache_key = (auth_data.type, auth_data.id, auth_data.reference)
+        #
+        with self.module.user_cache_lock:
+            cached = self.module.user_profile_cache.get(cache_key)
+        if cached is None:
+            cached, complete = self._make_profile(auth_data)
+            # Incomplete profile (lookup timed out) is served once, not cached
+            if complete:
+                with self.module.user_cache_lock:
+                    self.module.user_profile_cache[cache_key] = cached
+        _, body, etag = cached
+        #
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def _make_profile(self, auth_data) -> tuple:
+        """ Assemble user profile, independent lookups run concurrently: (profile, complete) """
+        executor = self.module.rpc_executor
+        avatar_future = executor.submit(self._get_avatar, auth_data.reference)
+        #
+        user = dict(self.module.current_user(auth_data=auth_data))
+        complete = True
         try:
             project_id = self.module.context.rpc_manager.timeout(2).projects_get_personal_project_id(user['id'])
             user['personal_project_id'] = project_id
         except Empty:
-            ...
+            complete = False
+        user['avatar'] = avatar_future.result()
+        #
+        body = current_app.json.dumps(user)
+        etag = hashlib.sha1(body.encode()).hexdigest()
+        return (user['id'], body, etag), complete
+
+    @staticmethod
+    def _get_avatar(reference):
         try:
-            auth_ctx = auth.get_referenced_auth_context(g.auth.reference)
-            avatar = auth_ctx['provider_attr']['attributes']['picture']
+            auth_ctx = auth.get_referenced_auth_context(reference)
+            return auth_ctx['provider_attr']['attributes']['picture']
         except (AttributeError, KeyError):
-            avatar = None
-        user['avatar'] = avatar
-        return jsonify(user)
+            return None
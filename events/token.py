@@ -0,0 +1,8 @@
+from pylon.core.tools import web, log
+
+
+class Event:
+    @web.event("auth_token_deleted")
+    def token_deleted(self, context, event, payload):
+        """ Reject deleted token and drop its cached data on every worker """
+        self.revoke_token_locally(payload["id"])
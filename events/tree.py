@@ -0,0 +1,18 @@
+from pylon.core.tools import web, log
+
+
+class Event:
+    @web.event("auth_group_tree_changed")
+    def group_tree_changed(self, context, event, payload):
+        """ Apply group tree change to local index """
+        self.group_tree.apply_change(payload)
+
+    @web.event("auth_scope_tree_changed")
+    def scope_tree_changed(self, context, event, payload):
+        """ Apply scope tree change to local index """
+        self.scope_tree.apply_change(payload)
+
+    @web.event("auth_user_groups_changed")
+    def user_groups_changed(self, context, event, payload):
+        """ Drop cached group membership of user """
+        self.invalidate_user_groups(payload["id"])
@@ -0,0 +1,8 @@
+from pylon.core.tools import web, log
+
+
+class Event:
+    @web.event("auth_user_updated")
+    def user_updated(self, context, event, payload):
+        """ Drop cached user data on every worker """
+        self.invalidate_user_caches(payload["id"])
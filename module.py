@@ -18,8 +18,19 @@
 """ Module """
 
 import re
+import sys
+import json
+import collections
 import time
+import heapq
+import hmac
+import hashlib
+import ipaddress
+import random
+import datetime
 import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import flask  # pylint: disable=E0401
@@ -32,7 +43,11 @@ from pylon.core.tools import log  # pylint: disable=E0611,E0401
 from pylon.core.tools import module  # pylint: disable=E0401
 from pylon.core.tools.context import Context as Holder  # pylint: disable=E0401
 
-from .models.pd.permissions import Permissions
+from .utils.pagination import paginate
+from .utils.ratelimit import RateLimiter, retry_after_header
+from .utils.tree import TreeIndex
+from .utils.permissions import PermissionSet, returns_permission_set, \
+    permissions_cache_key, permissions_version
 
 try:
     from tools import constants as c  # pylint: disable=E0401
@@ -63,13 +78,14 @@ def generate_permissions(permission_dict: dict[str, str]) -> set[str]:
     return result
 
 
-def generate_permissions_from_string(permission_string: str) -> set[str]:
+@functools.lru_cache(maxsize=4096)
+def generate_permissions_from_string(permission_string: str) -> frozenset[str]:
     """
-    Generate permissions from string.
+    Generate permissions from string. Results are memoized.
 
     :param permission_string: String with permissions.
 
-    :return: generated list of permissions.
+    :return: generated set of permissions.
     """
     permission_dict = {
         'section': None,
@@ -82,12 +98,35 @@ def generate_permissions_from_string(permission_string: str) -> set[str]:
     for permission_part, permission in zip(permissions, permission_dict.keys()):
         permission_dict[permission] = permission_part
 
-    return generate_permissions(permission_dict)
+    return frozenset(generate_permissions(permission_dict))
+
+
+def required_permissions_list(permissions: list | dict) -> list:
+    """ Required permissions from decorator argument, without pydantic """
+    if isinstance(permissions, dict):
+        return permissions["permissions"]
+    return permissions
+
+
+def user_cache_key(user_id=None, **kwargs):
+    """ Cache key for per-user proxies, same for positional and keyword user_id """
+    return cachetools.keys.hashkey(user_id, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def default_recommended_roles() -> tuple:
+    """ Default (mode, role) pairs to grant registered permissions to """
+    from .models.pd.permissions import RecommendedRoles  # pylint: disable=C0415
+    return tuple(
+        (mode, role)
+        for mode, roles in RecommendedRoles().dict().items()
+        for role, value in roles.items()
+        if value
+    )
 
 
 def has_access(user_permissions: set, required_permissions: list | dict) -> bool:
-    if isinstance(required_permissions, dict):
-        required_permissions = Permissions.parse_obj(required_permissions).permissions
+    required_permissions = required_permissions_list(required_permissions)
 
     # from collections import defaultdict
     # import json
@@ -111,7 +150,10 @@ def has_access(user_permissions: set, required_permissions: list | dict) -> bool
     if not required_permissions:
         return True
 
-    return bool(set(required_permissions).intersection(set(user_permissions)))
+    if not isinstance(user_permissions, PermissionSet):
+        user_permissions = PermissionSet(user_permissions)
+
+    return any(user_permissions.allows(permission) for permission in required_permissions)
 
 
 class Module(module.ModuleModel):  # pylint: disable=R0902
@@ -218,19 +260,100 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
         # SIO auth data
         self.sio_users = dict()  # sid -> auth_data
         self.local_permissions = set()
+        self.permission_manifest_lock = threading.Lock()
+        self.permission_manifest = {}  # plugin -> {(role, mode, permission)}
+        self.permission_manifest_applied = {}  # plugin -> rows pushed by this process
+        self.permission_manifest_dirty = set()
+        self.permission_manifest_timer = None  # single timer, re-armed until deadline
+        self.permission_manifest_deadline = 0.0
+        self.permission_manifest_backoff = 0.0
+        self.permission_manifest_supported = True  # cleared on first manifest RPC failure
+        self.permission_universe = ((), {}, permissions_version(()))  # (sorted, index, version)
+        self.permission_versions = cachetools.LRUCache(maxsize=4096)  # version -> permissions
         #
         self.auth_mode = "traefik"
         self.public_rules = []  # [rule]
+        self.lazy_rpcs = {}  # proxy name -> RPC name, resolved on first access
+        self.geoip = None
+        #
+        self.permission_modes = ("administration", "developer", "default")
+        self.permissions_cache_lock = threading.RLock()
+        self.user_permissions_cache = cachetools.TTLCache(maxsize=4096, ttl=60)
+        self.token_permissions_cache = cachetools.TTLCache(maxsize=4096, ttl=60)
+        self.rpc_executor = None
+        self.bulk_executor = None
+        #
+        self.slot_requirements = []  # requirement id -> required permissions
+        #
+        self.request_hooks = ((), ())  # (before stages, after stages)
+        self.trace_enabled = False
+        self.permission_traces = collections.deque(maxlen=100)
+        #
+        self.authorize_allowlists = (None, None)  # (headers, cookies), None: forward all
+        self.authorize_additions = (frozenset(), frozenset())  # registered by providers
+        self.session_cookie_name = self.descriptor.config.get("session_cookie_name", None)
+        #
+        self.user_cache_lock = threading.RLock()
+        self.user_cache = cachetools.TTLCache(maxsize=1024, ttl=60)
+        self.user_profile_cache = cachetools.TTLCache(maxsize=1024, ttl=60)  # auth -> (user_id, body, etag)
+        #
+        self.token_cache_lock = threading.RLock()
+        self.token_cache = cachetools.TTLCache(maxsize=1024, ttl=60)
+        self.token_user_cache = cachetools.TTLCache(maxsize=4096, ttl=60)  # token_id -> user
+        #
+        # Bounded: tokens evicted from here are still rejected by auth pylon
+        self.revoked_tokens = cachetools.LRUCache(maxsize=65536)  # token ID -> True
+        self.token_expires = {}  # token ID -> expiry timestamp
+        self.token_expiry_heap = []  # (expiry timestamp, token ID)
+        self.token_state_lock = threading.Lock()
+        # Authorization header -> token ID, lets rpc mode reject known tokens before authorize
+        self.token_credentials = cachetools.LRUCache(maxsize=4096)
+        #
+        self.group_tree = TreeIndex(lambda: self.list_groups())
+        self.scope_tree = TreeIndex(lambda: self.list_scopes())
+        self.user_group_ids_cache = cachetools.TTLCache(maxsize=4096, ttl=60)
+        #
+        self.listing_cache_lock = threading.Lock()
+        self.listing_cache = cachetools.TTLCache(maxsize=8, ttl=30)  # (list, args) -> sorted items
+        self.paged_listings = (
+            "list_users", "list_tokens", "list_groups", "list_user_groups",
+        )
+        self.authorize_payload_lock = threading.Lock()
+        self.authorize_payload_stats = {"requests": 0, "bytes_sent": 0, "bytes_dropped": 0}
 
     #
     # Module
     #
 
-    def init(self):
+    def init(self):  # pylint: disable=R0915
         """ Init module """
         log.info("Initializing module")
+        timings = []
+        phase_start = time.perf_counter()
+        #
+        def _phase_done(name):
+            nonlocal phase_start
+            now = time.perf_counter()
+            timings.append(f"{name}={(now - phase_start) * 1000:.1f}ms")
+            phase_start = now
         # Config
+        lazy_init = self.descriptor.config.get("lazy_init", False)
         self.auth_mode = self.descriptor.config.get("auth_mode", self.auth_mode).lower()
+        self.permission_modes = tuple(
+            self.descriptor.config.get("permission_modes", self.permission_modes)
+        )
+        # Pool for fan-out RPC calls (bulk permission resolution and so on)
+        self.rpc_executor = ThreadPoolExecutor(
+            max_workers=self.descriptor.config.get("rpc_fanout_workers", 8),
+            thread_name_prefix="auth_rpc_fanout",
+        )
+        # Separate pool for admin bulk lookups, so they don't delay page requests
+        self.bulk_executor = ThreadPoolExecutor(
+            max_workers=self.descriptor.config.get("bulk_fanout_workers", 4),
+            thread_name_prefix="auth_bulk_fanout",
+        )
+        # Max items per bulk API / RPC call
+        self.bulk_limit = self.descriptor.config.get("bulk_limit", 1000)
         # Add decorators
         self.decorators.check = self._decorator_check
         self.decorators.check_api = self._decorator_check_api
@@ -239,6 +362,7 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
         self.decorators.sio_connect = self._decorator_sio_connect
         self.decorators.sio_disconnect = self._decorator_sio_disconnect
         self.decorators.sio_check = self._decorator_sio_check
+        _phase_done("config")
         # Register RPC proxies
         rpc_call = self.context.rpc_manager.timeout(15)
         #
@@ -246,12 +370,24 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
             if hasattr(self, proxy_name):
                 raise RuntimeError(f"Name '{proxy_name}' is already set")
             #
-            setattr(self, proxy_name, getattr(rpc_call, rpc_name))
+            if lazy_init:
+                self.lazy_rpcs[proxy_name] = rpc_name
+            else:
+                setattr(self, proxy_name, getattr(rpc_call, rpc_name))
         #
+        _phase_done("rpc_proxies")
         self.has_access = has_access  # pylint: disable=W0201
         # Register auth tool
         self.descriptor.register_tool("auth", self)
         # Add hooks
+        self.build_authorize_allowlists()
+        if self.session_cookie_name is None and \
+                self.descriptor.config.get("session_cookie_name_lookup", False):
+            threading.Thread(
+                target=self._lookup_session_cookie_name,
+                name="auth_session_cookie_lookup", daemon=True,
+            ).start()
+        self.build_request_hooks()
         self.context.app.before_request(self._before_request_hook)
         self.context.app.after_request(self._after_request_hook)
         # Register configured public rules
@@ -259,26 +395,67 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
             self.add_public_rule(public_rule)
 
         self.register_permissions = self._reg_permissions
+        _phase_done("hooks")
 
         # Enable cache
         # FIXME: maybe this creates malfunctions
         self.get_user_permissions = cachetools.cached(  # pylint: disable=W0201
-            cache=cachetools.TTLCache(maxsize=1024, ttl=60)
-        )(self.get_user_permissions)
+            cache=self.user_permissions_cache,
+            key=permissions_cache_key,
+            lock=self.permissions_cache_lock,
+        )(returns_permission_set(self.get_user_permissions))
         self.get_token_permissions = cachetools.cached(  # pylint: disable=W0201
-            cache=cachetools.TTLCache(maxsize=1024, ttl=60)
-        )(self.get_token_permissions)
+            cache=self.token_permissions_cache,
+            key=permissions_cache_key,
+            lock=self.permissions_cache_lock,
+        )(returns_permission_set(self.get_token_permissions))
         self.get_user = cachetools.cached(  # pylint: disable=W0201
-            cache=cachetools.TTLCache(maxsize=1024, ttl=60)
+            cache=self.user_cache, key=user_cache_key, lock=self.user_cache_lock,
         )(self.get_user)
         self.get_token = cachetools.cached(  # pylint: disable=W0201
-            cache=cachetools.TTLCache(maxsize=1024, ttl=60)
-        )(self.get_token)
+            cache=self.token_cache, lock=self.token_cache_lock,
+        )(self._indexing_token_expiry(self.get_token))
+        # Mutations fire events, so that every worker drops stale cached data
+        self.update_user = self._fire_event_after(  # pylint: disable=W0201
+            self.update_user, "auth_user_updated", "user_id", "id"
+        )
+        self.delete_user = self._fire_event_after(  # pylint: disable=W0201
+            self.delete_user, "auth_user_updated", "user_id", "id"
+        )
+        self.delete_token = self._fire_event_after(  # pylint: disable=W0201
+            self.delete_token, "auth_token_deleted", "token_id", "id"
+        )
+        self.get_user_group_ids = cachetools.cached(  # pylint: disable=W0201
+            cache=self.user_group_ids_cache, key=user_cache_key, lock=self.user_cache_lock,
+        )(self.get_user_group_ids)
+        self.add_user_group = self._fire_event_after(  # pylint: disable=W0201
+            self.add_user_group, "auth_user_groups_changed", "user_id"
+        )
+        self.remove_user_group = self._fire_event_after(  # pylint: disable=W0201
+            self.remove_user_group, "auth_user_groups_changed", "user_id"
+        )
+        # Tree changes are applied to local group/scope indexes
+        self.add_group = self._fire_tree_event_after(  # pylint: disable=W0201
+            self.add_group, "auth_group_tree_changed", "add"
+        )
+        self.delete_group = self._fire_tree_event_after(  # pylint: disable=W0201
+            self.delete_group, "auth_group_tree_changed", "delete"
+        )
+        self.add_scope = self._fire_tree_event_after(  # pylint: disable=W0201
+            self.add_scope, "auth_scope_tree_changed", "add"
+        )
+        self.delete_scope = self._fire_tree_event_after(  # pylint: disable=W0201
+            self.delete_scope, "auth_scope_tree_changed", "delete"
+        )
+        _phase_done("caches")
         # Load GeoIP databases
-        try:
-            self.geoip = pygeoip.GeoIP("/usr/share/GeoIP/GeoIP.dat")  # pylint: disable=W0201
-        except:  # pylint: disable=W0702
-            self.geoip = None  # pylint: disable=W0201
+        if lazy_init:
+            threading.Thread(
+                target=self._load_geoip, name="auth_geoip_load", daemon=True,
+            ).start()
+        else:
+            self._load_geoip()
+        _phase_done("geoip")
         #
         # try:
         #     self.geoip6 = pygeoip.GeoIP("/usr/share/GeoIP/GeoIPv6.dat")  # pylint: disable=W0201
@@ -287,44 +464,54 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
         # Debug
         # if self.context.debug:
         self.descriptor.init_api()
+        _phase_done("api")
         self.descriptor.init_rpcs()
+        self.descriptor.init_events()
+        _phase_done("rpcs_events")
+        #
+        log.info("Init timing (lazy=%s): %s", lazy_init, ", ".join(timings))
         #
         # log.info("Running DB migrations")
         # db_migrations.run_db_migrations(self, db.url)
 
-    def _after_request_hook(self, response):
-        additional_headers = self.descriptor.config.get(
-            "additional_headers", {}
-        )
-        for key, value in additional_headers.items():
-            response.headers[key] = value
-        #
-        if c.ALLOW_CORS:
-            if request.method == 'OPTIONS':
-                response = make_response()
-                response.status_code = 200
-                response.headers.add('Access-Control-Allow-Headers', '*')
-                response.headers.add('Access-Control-Allow-Methods', '*')
-                response.headers.add('Access-Control-Allow-Credentials', 'true')
-            response.headers.add('Access-Control-Allow-Origin', '*')
-        #
-        additional_default_headers = self.descriptor.config.get(
-            "additional_default_headers", {}
-        )
-        for key, value in additional_default_headers.items():
-            if key not in response.headers:
-                response.headers[key] = value
-        #
-        return response
-
     def deinit(self):  # pylint: disable=R0201
         """ De-init module """
         log.info("De-initializing module")
+        # Push registrations still waiting for the flush deadline
+        with self.permission_manifest_lock:
+            if self.permission_manifest_timer is not None:
+                self.permission_manifest_timer.cancel()
+                self.permission_manifest_timer = None
+        self.flush_permissions(retry=False)
         # Unregister auth tool
         self.descriptor.unregister_tool("auth")
         # Unregister RPC proxies
         for proxy_name, _ in self._rpcs:
-            delattr(self, proxy_name)
+            if proxy_name in self.__dict__:
+                delattr(self, proxy_name)
+        self.lazy_rpcs.clear()
+        #
+        if self.rpc_executor is not None:
+            self.rpc_executor.shutdown(wait=False)
+        if self.bulk_executor is not None:
+            self.bulk_executor.shutdown(wait=False)
+
+    def __getattr__(self, name):
+        # Called for missing attributes only: resolve lazy RPC proxy on first use
+        rpc_name = self.__dict__.get("lazy_rpcs", {}).get(name)
+        if rpc_name is None:
+            raise AttributeError(name)
+        #
+        proxy = getattr(self.context.rpc_manager.timeout(15), rpc_name)
+        setattr(self, name, proxy)
+        return proxy
+
+    def _load_geoip(self):
+        try:
+            geoip = pygeoip.GeoIP("/usr/share/GeoIP/GeoIP.dat")
+        except:  # pylint: disable=W0702
+            geoip = None
+        self.geoip = geoip  # pylint: disable=W0201
 
     #
     # Ping: check if auth pylon is connected
@@ -350,81 +537,284 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
     # Hooks
     #
 
-    def _before_request_hook(self):  # pylint: disable=R0912,R0915
-        flask.session.permanent = True
+    def build_request_hooks(self):
+        """ Build per-request hook stages from config, replace current ones atomically """
+        config = self.descriptor.config
         #
-        if self.descriptor.config.get("force_https_redirect", False) and \
-                flask.request.host not in self.descriptor.config.get(
-                    "https_redirect_excludes", []
-                ):
-            if flask.request.scheme == "http":
-                log.info("HTTP -> HTTPS redirect for host: %s", flask.request.host)
-                return flask.redirect(flask.request.url.replace("http://", "https://", 1))
+        before_stages = []
+        # CORS preflights are answered before any auth work
+        if c.ALLOW_CORS:
+            before_stages.append(functools.partial(
+                self._before_cors_preflight_stage,
+                (
+                    ("Access-Control-Allow-Origin", "*"),
+                    ("Access-Control-Allow-Headers", "*"),
+                    ("Access-Control-Allow-Methods", "*"),
+                    ("Access-Control-Allow-Credentials", "true"),
+                    ("Access-Control-Max-Age", str(config.get("cors_max_age", 7200))),
+                ),
+            ))
         #
-        flask.g.auth = Holder()
+        before_stages.append(self._before_session_stage)
         #
-        if self.auth_mode == "rpc":
-            # Collect data
-            source_uri = flask.request.full_path
-            if not flask.request.query_string and source_uri.endswith("?"):
-                source_uri = source_uri[:-1]
-            source_uri = f'{self.context.url_prefix}{source_uri}'
-            #
-            source = {
-                "method": flask.request.method,
-                "proto": flask.request.scheme,
-                "host": flask.request.host,
-                "uri": source_uri,
-                "ip": flask.request.remote_addr,
-                "target": "rpc",
-                "scope": None,
-            }
-            headers = dict(flask.request.headers.items())
-            cookies = dict(flask.request.cookies.items())
-            # Check public rules
-            is_public_route = False
-            for rule in self.public_rules:
-                if self.public_rule_matches(rule, source):
-                    is_public_route = True
-            # Call authorize RPC
-            try:
-                auth_status = self.context.rpc_manager.timeout(5).auth_authorize(
-                    source, headers, cookies
+        trace_always = config.get("permission_trace", False)
+        trace_secret = config.get("permission_trace_secret", None)
+        self.trace_enabled = bool(trace_always or trace_secret)
+        if self.trace_enabled:
+            before_stages.append(functools.partial(
+                self._before_trace_stage, trace_always, trace_secret,
+            ))
+        #
+        rate_limit = config.get("rate_limit", {})
+        if rate_limit.get("enabled", False):
+            route_classes = tuple(
+                (
+                    item["name"],
+                    re.compile(item["pattern"]),
+                    RateLimiter(
+                        item.get("rate", rate_limit.get("rate", 20)),
+                        item.get("burst", rate_limit.get("burst", 40)),
+                    ),
                 )
-            except:  # pylint: disable=W0702
-                self._make_public_g_auth()
-            else:
-                if auth_status["auth_ok"]:
-                    flask.g.auth.type = auth_status["headers"].get("X-Auth-Type", "public")
-                    flask.g.auth.id = auth_status["headers"].get("X-Auth-ID", "-")
-                    flask.g.auth.reference = auth_status["headers"].get(
-                        "X-Auth-Reference", "-"
-                    )
-                elif is_public_route:
-                    self._make_public_g_auth()
-                elif auth_status["action"] == "redirect":
-                    return flask.redirect(auth_status["target"])
-                elif auth_status["action"] == "make_response":
-                    return flask.make_response(auth_status["data"], auth_status["status_code"])
-                else:
-                    return self.access_denied_reply()
-            #
+                for item in rate_limit.get("route_classes", [])
+            ) + ((
+                "default",
+                re.compile(".*"),
+                RateLimiter(rate_limit.get("rate", 20), rate_limit.get("burst", 40)),
+            ),)
+            before_stages.append(functools.partial(
+                self._before_ip_rate_limit_stage,
+                route_classes,
+                rate_limit.get("use_masked_ip", False),
+                rate_limit.get("trusted_proxy_hops", 0),
+            ))
+        #
+        if config.get("force_https_redirect", False):
+            before_stages.append(functools.partial(
+                self._before_https_redirect_stage,
+                frozenset(config.get("https_redirect_excludes", [])),
+            ))
         #
+        if self.auth_mode == "rpc":
+            before_stages.append(self._before_auth_rpc_stage)
         elif self.auth_mode == "traefik":
-            flask.g.auth.type = flask.request.headers.get("X-Auth-Type", "public")
-            flask.g.auth.id = flask.request.headers.get("X-Auth-ID", "-")
-            flask.g.auth.reference = flask.request.headers.get(
-                "X-Auth-Reference", "-"
+            before_stages.append(self._before_auth_traefik_stage)
+        else:
+            before_stages.append(self._before_auth_public_stage)
+        #
+        before_stages.append(self._before_auth_id_stage)
+        before_stages.append(self._before_token_check_stage)
+        if rate_limit.get("enabled", False):
+            before_stages.append(self._before_identity_rate_limit_stage)
+        before_stages.append(self._before_visitor_stage)
+        #
+        after_stages = []
+        #
+        additional_headers = tuple(config.get("additional_headers", {}).items())
+        if additional_headers:
+            after_stages.append(functools.partial(
+                self._after_headers_stage, additional_headers,
+            ))
+        #
+        if c.ALLOW_CORS:
+            after_stages.append(self._after_cors_stage)
+        #
+        if self.trace_enabled:
+            after_stages.append(self._after_trace_stage)
+        #
+        additional_default_headers = tuple(
+            config.get("additional_default_headers", {}).items()
+        )
+        if additional_default_headers:
+            after_stages.append(functools.partial(
+                self._after_default_headers_stage, additional_default_headers,
+            ))
+        # Single assignment: requests in flight see either old or new chain
+        self.request_hooks = (tuple(before_stages), tuple(after_stages))
+
+    def _before_request_hook(self):
+        before_stages, _ = self.request_hooks
+        for stage in before_stages:
+            response = stage()
+            if response is not None:
+                return response
+        #
+        return None
+
+    @staticmethod
+    def _before_cors_preflight_stage(headers):
+        if request.method != "OPTIONS":
+            return None
+        #
+        response = make_response()
+        response.status_code = 200
+        for key, value in headers:
+            response.headers[key] = value
+        return response
+
+    @staticmethod
+    def _rate_limit_client_ip(use_masked_ip, trusted_proxy_hops):
+        """
+        Client IP for rate limiting.
+
+        Behind traefik remote_addr is the proxy: set trusted_proxy_hops to the
+        number of proxies adding X-Forwarded-For (or apply ProxyFix), else all
+        clients share one bucket.
+        """
+        ip = str(flask.request.remote_addr)
+        if trusted_proxy_hops:
+            forwarded = [
+                item.strip()
+                for item in flask.request.headers.get("X-Forwarded-For", "").split(",")
+                if item.strip()
+            ]
+            if len(forwarded) >= trusted_proxy_hops:
+                ip = forwarded[-trusted_proxy_hops]
+        #
+        if use_masked_ip:
+            try:
+                address = ipaddress.ip_address(ip)
+                prefix = 24 if address.version == 4 else 64
+                ip = str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+            except ValueError:
+                pass
+        #
+        return ip
+
+    def _before_ip_rate_limit_stage(self, route_classes, use_masked_ip, trusted_proxy_hops):
+        ip = self._rate_limit_client_ip(use_masked_ip, trusted_proxy_hops)
+        #
+        for name, pattern, limiter in route_classes:
+            if pattern.match(flask.request.path):
+                flask.g.rate_limit = (name, limiter)
+                retry_after = limiter.allow(("ip", ip))
+                break
+        #
+        if retry_after:
+            log.warning("Rate limited: %s %s", name, ip)
+            return flask.make_response(
+                "Too Many Requests", 429, {"Retry-After": retry_after_header(retry_after)}
             )
+        return None
+
+    @staticmethod
+    def _before_identity_rate_limit_stage():
+        if flask.g.auth.type == "public":
+            return None
         #
-        else:
+        name, limiter = flask.g.rate_limit
+        retry_after = limiter.allow(("id", flask.g.auth.type, flask.g.auth.id))
+        if retry_after:
+            log.warning("Rate limited: %s %s:%s", name, flask.g.auth.type, flask.g.auth.id)
+            return flask.make_response(
+                "Too Many Requests", 429, {"Retry-After": retry_after_header(retry_after)}
+            )
+        return None
+
+    @staticmethod
+    def _before_session_stage():
+        flask.session.permanent = True
+
+    @staticmethod
+    def _before_https_redirect_stage(excludes):
+        if flask.request.scheme == "http" and flask.request.host not in excludes:
+            log.info("HTTP -> HTTPS redirect for host: %s", flask.request.host)
+            return flask.redirect(flask.request.url.replace("http://", "https://", 1))
+        return None
+
+    def _before_auth_rpc_stage(self):
+        flask.g.auth = Holder()
+        # Collect data
+        source_uri = flask.request.full_path
+        if not flask.request.query_string and source_uri.endswith("?"):
+            source_uri = source_uri[:-1]
+        source_uri = f'{self.context.url_prefix}{source_uri}'
+        #
+        source = {
+            "method": flask.request.method,
+            "proto": flask.request.scheme,
+            "host": flask.request.host,
+            "uri": source_uri,
+            "ip": flask.request.remote_addr,
+            "target": "rpc",
+            "scope": None,
+        }
+        headers, cookies = self.trim_authorize_credentials(
+            flask.request.headers, flask.request.cookies
+        )
+        # Check public rules
+        is_public_route = False
+        for rule in self.public_rules:
+            if self.public_rule_matches(rule, source):
+                is_public_route = True
+        # Revoked or expired token seen before: no authorize RPC
+        credential = flask.request.headers.get("Authorization", None)
+        if credential is not None:
+            with self.token_state_lock:
+                token_id = self.token_credentials.get(credential, None)
+            if token_id is not None and self.token_rejected(token_id):
+                return self.access_denied_reply()
+        # Call authorize RPC
+        try:
+            auth_status = self.context.rpc_manager.timeout(5).auth_authorize(
+                source, headers, cookies
+            )
+        except:  # pylint: disable=W0702
             self._make_public_g_auth()
+        else:
+            if auth_status["auth_ok"]:
+                flask.g.auth.type = auth_status["headers"].get("X-Auth-Type", "public")
+                flask.g.auth.id = auth_status["headers"].get("X-Auth-ID", "-")
+                flask.g.auth.reference = auth_status["headers"].get(
+                    "X-Auth-Reference", "-"
+                )
+                if credential is not None and flask.g.auth.type == "token":
+                    self._remember_token_credential(credential, flask.g.auth.id)
+            elif is_public_route:
+                self._make_public_g_auth()
+            elif auth_status["action"] == "redirect":
+                return flask.redirect(auth_status["target"])
+            elif auth_status["action"] == "make_response":
+                return flask.make_response(auth_status["data"], auth_status["status_code"])
+            else:
+                return self.access_denied_reply()
         #
+        return None
+
+    @staticmethod
+    def _before_auth_traefik_stage():
+        flask.g.auth = Holder()
+        flask.g.auth.type = flask.request.headers.get("X-Auth-Type", "public")
+        flask.g.auth.id = flask.request.headers.get("X-Auth-ID", "-")
+        flask.g.auth.reference = flask.request.headers.get(
+            "X-Auth-Reference", "-"
+        )
+
+    def _before_auth_public_stage(self):
+        flask.g.auth = Holder()
+        self._make_public_g_auth()
+
+    @staticmethod
+    def _before_auth_id_stage():
         try:
             flask.g.auth.id = int(flask.g.auth.id)
         except:  # pylint: disable=W0702
             flask.g.auth.id = "-"
-        #
+
+    def _remember_token_credential(self, credential, token_id):
+        try:
+            token_id = int(token_id)
+        except:  # pylint: disable=W0702
+            return
+        with self.token_state_lock:
+            self.token_credentials[credential] = token_id
+
+    def _before_token_check_stage(self):
+        if flask.g.auth.type == "token" and self.token_rejected(flask.g.auth.id):
+            return self.access_denied_reply()
+        return None
+
+    def _before_visitor_stage(self):
         flask.g.visitor = Holder()
         #
         flask.g.visitor.ip = flask.request.remote_addr
@@ -455,8 +845,115 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
         )
         #
         log.info("Visitor: %s", visitor_event)
+
+    def _after_request_hook(self, response):
+        _, after_stages = self.request_hooks
+        for stage in after_stages:
+            response = stage(response)
         #
-        return None
+        return response
+
+    @staticmethod
+    def _after_headers_stage(headers, response):
+        for key, value in headers:
+            response.headers[key] = value
+        return response
+
+    @staticmethod
+    def _after_cors_stage(response):
+        # Preflight replies already carry full CORS headers
+        if 'Access-Control-Allow-Origin' not in response.headers:
+            response.headers.add('Access-Control-Allow-Origin', '*')
+        return response
+
+    @staticmethod
+    def _after_default_headers_stage(headers, response):
+        for key, value in headers:
+            if key not in response.headers:
+                response.headers[key] = value
+        return response
+
+    #
+    # Hooks: auth_authorize payload
+    #
+
+    def build_authorize_allowlists(self):
+        """ Build headers/cookies allowlists for auth_authorize from config and providers """
+        config = self.descriptor.config
+        extra_headers, extra_cookies = self.authorize_additions
+        #
+        header_names = config.get("authorize_headers", None)
+        if header_names is not None:
+            header_names = frozenset(
+                item.lower() for item in header_names
+            ) | extra_headers
+        #
+        cookie_names = config.get("authorize_cookies", None)
+        if cookie_names is not None:
+            cookie_names = frozenset(cookie_names) | extra_cookies
+            # Session cookie is always needed: if its name is not known
+            # (session_cookie_name config or startup lookup), all cookies are forwarded
+            if self.session_cookie_name is None:
+                cookie_names = None
+            else:
+                cookie_names |= {self.session_cookie_name}
+        #
+        self.authorize_allowlists = (header_names, cookie_names)
+
+    def _lookup_session_cookie_name(self):
+        # One attempt, off the init and request paths
+        try:
+            self.session_cookie_name = \
+                self.context.rpc_manager.timeout(5).auth_get_session_cookie_name()
+        except:  # pylint: disable=W0702
+            log.warning("Failed to get session cookie name, forwarding all cookies")
+            return
+        #
+        self.build_authorize_allowlists()
+
+    def register_authorize_credentials(self, headers=(), cookies=()):
+        """ Auth providers: add headers/cookies that must reach auth_authorize """
+        extra_headers, extra_cookies = self.authorize_additions
+        self.authorize_additions = (
+            extra_headers | {item.lower() for item in headers},
+            extra_cookies | set(cookies),
+        )
+        self.build_authorize_allowlists()
+
+    def trim_authorize_credentials(self, headers, cookies) -> tuple:
+        """ Keep only allowlisted headers and cookies, account payload size """
+        header_names, cookie_names = self.authorize_allowlists
+        #
+        sent = dropped = 0
+        result_headers = {}
+        for key, value in headers.items():
+            size = len(key) + len(value)
+            if header_names is None or key.lower() in header_names:
+                result_headers[key] = value
+                sent += size
+            else:
+                dropped += size
+        #
+        result_cookies = {}
+        for key, value in cookies.items():
+            size = len(key) + len(value)
+            if cookie_names is None or key in cookie_names:
+                result_cookies[key] = value
+                sent += size
+            else:
+                dropped += size
+        #
+        with self.authorize_payload_lock:
+            self.authorize_payload_stats["requests"] += 1
+            self.authorize_payload_stats["bytes_sent"] += sent
+            self.authorize_payload_stats["bytes_dropped"] += dropped
+        #
+        return result_headers, result_cookies
+
+    def get_authorize_payload_stats(self) -> dict:
+        """ auth_authorize payload size metric """
+        with self.authorize_payload_lock:
+            return dict(self.authorize_payload_stats)
 
     @staticmethod
     def _make_public_g_auth():
@@ -539,28 +1036,155 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
         #
         return _decorator
 
-    def update_local_permissions(self, permissions: list | dict):
-        """ Update local permissions """
+    def update_local_permissions(self, permissions: list | dict, plugin: Optional[str] = None):
+        """ Update local permissions, plugin defaults to the calling plugin """
 
         if not isinstance(permissions, dict):
             permissions = {"permissions": permissions}
 
-        self._create_template_permissions(permissions)
+        self._create_template_permissions(permissions, plugin or self._caller_plugin())
 
-    def _create_template_permissions(self, permissions: dict):
+    def _create_template_permissions(self, permissions: dict, plugin: str):
         result = []
-        perm_obj = Permissions.parse_obj(permissions)
-        if not perm_obj.permissions:
+        if "recommended_roles" in permissions:
+            # Explicit roles are validated, defaults are prepared once
+            from .models.pd.permissions import Permissions  # pylint: disable=C0415
+            perm_obj = Permissions.parse_obj(permissions)
+            perm_list = perm_obj.permissions
+            mode_roles = [
+                (mode, role)
+                for mode, roles in perm_obj.recommended_roles.dict().items()
+                for role, value in roles.items()
+                if value
+            ]
+        else:
+            perm_list = permissions["permissions"]
+            mode_roles = default_recommended_roles()
+        if not perm_list:
             return
-        for perm in perm_obj.permissions:
-            for mode, roles in perm_obj.recommended_roles.dict().items():
-                for role, value in roles.items():
-                    if value:
-                        result.append((role, mode, perm))
+        for perm in perm_list:
+            for mode, role in mode_roles:
+                result.append((role, mode, perm))
             self.local_permissions.update(generate_permissions_from_string(perm))
 
         if result:
-            self.insert_permissions(result)
+            self._queue_permissions(plugin, result)
+
+    #
+    # Permissions manifest: registrations are collected per plugin and pushed
+    # to auth pylon in one batch, only for plugins whose manifest changed
+    #
+
+    @staticmethod
+    def _caller_plugin() -> str:
+        # Module name of the first caller outside this file: plugins.<name>.*
+        frame = sys._getframe(1)  # pylint: disable=W0212
+        while frame is not None and frame.f_globals.get("__name__") == __name__:
+            frame = frame.f_back
+        if frame is None:
+            return "-"
+        parts = frame.f_globals.get("__name__", "-").split(".")
+        if parts[0] == "plugins" and len(parts) > 1:
+            return parts[1]
+        return parts[0]
+
+    def _queue_permissions(self, plugin: str, rows: list):
+        with self.permission_manifest_lock:
+            self.permission_manifest.setdefault(plugin, set()).update(rows)
+            self.permission_manifest_dirty.add(plugin)
+            # Debounce: registrations move the deadline, one timer waits for it
+            delay = self.descriptor.config.get("permissions_flush_delay", 1.0)
+            self.permission_manifest_deadline = time.monotonic() + delay
+            if self.permission_manifest_timer is None:
+                self._arm_permissions_flush(delay)
+
+    def _arm_permissions_flush(self, delay: float):
+        # Called with permission_manifest_lock held
+        self.permission_manifest_timer = threading.Timer(delay, self._permissions_flush_due)
+        self.permission_manifest_timer.daemon = True
+        self.permission_manifest_timer.start()
+
+    def _permissions_flush_due(self):
+        with self.permission_manifest_lock:
+            remaining = self.permission_manifest_deadline - time.monotonic()
+            if remaining > 0:
+                self._arm_permissions_flush(remaining)
+                return
+            self.permission_manifest_timer = None
+        self.flush_permissions()
+
+    def _disable_permission_manifests(self):
+        # Not retried: every later flush (deinit too) would wait for the timeout again
+        self.permission_manifest_supported = False
+        log.exception("Permission manifest exchange failed, pushing changes without it")
+
+    def flush_permissions(self, retry: bool = True):
+        """ Push changed plugins' permissions to auth pylon, retry with backoff on failure """
+        with self.permission_manifest_lock:
+            dirty = {
+                plugin: (
+                    frozenset(self.permission_manifest[plugin]),
+                    self.permission_manifest_applied.get(plugin, frozenset()),
+                )
+                for plugin in self.permission_manifest_dirty
+            }
+            self.permission_manifest_dirty.clear()
+        if not dirty:
+            return
+        #
+        digests = {
+            plugin: hashlib.sha1(repr(sorted(rows)).encode()).hexdigest()
+            for plugin, (rows, _) in dirty.items()
+        }
+        # Single question per flush: which manifests auth pylon already has
+        known = {}
+        if self.permission_manifest_supported:
+            try:
+                known = self.context.rpc_manager.timeout(5).auth_get_permission_manifests(
+                    list(digests)
+                ) or {}
+            except:  # pylint: disable=W0702
+                self._disable_permission_manifests()
+        #
+        delta = []
+        for plugin, (rows, applied) in dirty.items():
+            if known.get(plugin) == digests[plugin]:
+                log.debug("Permissions manifest of %s is up to date", plugin)
+            else:
+                delta.extend(rows - applied)
+        #
+        if delta:
+            log.info("Inserting %s permission rows", len(delta))
+            try:
+                self.insert_permissions(delta)
+            except:  # pylint: disable=W0702
+                with self.permission_manifest_lock:
+                    self.permission_manifest_dirty.update(dirty)
+                    if not retry:
+                        log.exception("Failed to insert permissions")
+                        return
+                    self.permission_manifest_backoff = min(
+                        max(self.permission_manifest_backoff * 2, 1.0), 60.0
+                    )
+                    self.permission_manifest_deadline = \
+                        time.monotonic() + self.permission_manifest_backoff
+                    if self.permission_manifest_timer is None:
+                        self._arm_permissions_flush(self.permission_manifest_backoff)
+                log.exception(
+                    "Failed to insert permissions, retry in %ss",
+                    self.permission_manifest_backoff,
+                )
+                return
+            if self.permission_manifest_supported:
+                try:
+                    self.context.rpc_manager.timeout(5).auth_set_permission_manifests(digests)
+                except:  # pylint: disable=W0702
+                    self._disable_permission_manifests()
+        #
+        with self.permission_manifest_lock:
+            self.permission_manifest_backoff = 0.0
+            for plugin, (rows, _) in dirty.items():
+                self.permission_manifest_applied[plugin] = rows
 
     #
     # Decorators
@@ -573,7 +1197,7 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
             **kwargs
     ):
         """ Check access to route """
-        self.update_local_permissions(permissions)
+        self.update_local_permissions(permissions, kwargs.get("plugin"))
 
         def _decorator(func):
             @functools.wraps(func)
@@ -581,16 +1205,18 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
                 #
                 # TBD: correct mode support
                 current_permissions = self.resolve_permissions(mode=mode)
+                allowed = has_access(current_permissions, permissions)
+                self._trace_access("check", current_permissions, permissions, allowed)
                 #
-                if has_access(current_permissions, permissions):
+                if allowed:
                     return func(*_args, **_kwargs)
                 #
                 return access_denied_reply, 403
             return _decorated
         return _decorator
 
-    def _reg_permissions(self, permissions: list | dict):
-        self.update_local_permissions(permissions)
+    def _reg_permissions(self, permissions: list | dict, plugin: Optional[str] = None):
+        self.update_local_permissions(permissions, plugin)
 
     def _decorator_check_api(
             self, permissions: list | dict,
@@ -599,14 +1225,10 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
             **kwargs
     ):
         """ Check access to API """
-        self.update_local_permissions(permissions)
+        self.update_local_permissions(permissions, kwargs.get("plugin"))
         if access_denied_reply is None:
             access_denied_reply = {"ok": False, "error": "access_denied"}
-        if add_verbose_info:
-            if isinstance(permissions, dict):
-                access_denied_reply['required'] = permissions.get('permissions', permissions)
-            else:
-                access_denied_reply['required'] = permissions
+        required = required_permissions_list(permissions)
 
         def _decorator(func):
             @functools.wraps(func)
@@ -635,12 +1257,18 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
                     mode=mode,
                     project_id=project_id
                 )
-                if has_access(current_permissions, permissions):
+                allowed = has_access(current_permissions, permissions)
+                self._trace_access("check_api", current_permissions, permissions, allowed)
+                if allowed:
                     return func(*_args, **_kwargs)
                 if add_verbose_info and isinstance(access_denied_reply, dict):
-                    access_denied_reply['mode'] = mode
-                    access_denied_reply['project_id'] = project_id
-                    access_denied_reply['current_permissions'] = list(current_permissions)
+                    # Fresh reply per request, shared one is never changed
+                    return {
+                        **access_denied_reply,
+                        **self.access_denied_diagnostics(
+                            current_permissions, required, mode, project_id
+                        ),
+                    }, 403
                 return access_denied_reply, 403
             return _decorated
         return _decorator
@@ -650,6 +1278,10 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
     ):
         """ Check access to slot """
         self.update_local_permissions(permissions)
+        #
+        permissions = required_permissions_list(permissions)
+        requirement_id = len(self.slot_requirements)
+        self.slot_requirements.append(permissions)
 
         #
         def _decorator(func):
@@ -661,17 +1293,7 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
                 if not isinstance(context, Holder):
                     return func(*_args, **_kvargs)
                 #
-                try:
-                    mode = flask.g.theme.active_mode
-                except AttributeError:
-                    mode = c.DEFAULT_MODE
-
-                current_permissions = self.resolve_permissions(
-                    mode=mode, auth_data=context.auth
-                )
-                log.debug("from check_slot %s %s %s", mode, current_permissions, permissions)
-                #
-                if has_access(current_permissions, permissions):
+                if self.slot_access(context.auth)[requirement_id]:
                     return func(*_args, **_kvargs)
                 #
                 return access_denied_reply, 403
@@ -731,6 +1353,38 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
     # Tools: access denied
     #
 
+    def access_denied_diagnostics(self, current_permissions, required: list,
+                                  mode: str, project_id: Optional[int]) -> dict:
+        """ Bounded details for access denied reply """
+        limit = self.descriptor.config.get("access_denied_diagnostics_limit", 20)
+        # Permissions held under the same parents as required ones
+        parents = tuple({item.rsplit(".", 1)[0] + "." for item in required})
+        matched = sorted(
+            item for item in current_permissions if item.startswith(parents)
+        ) if parents else []
+        #
+        result = {
+            "mode": mode,
+            "project_id": project_id,
+            "required": required[:limit],
+            "missing": [
+                item for item in required if item not in current_permissions
+            ][:limit],
+            "matched": matched[:limit],
+        }
+        #
+        if self.context.debug:
+            result["current_permissions"] = list(current_permissions)
+        elif random.random() < self.descriptor.config.get(
+                "access_denied_dump_sample_rate", 0.0
+        ):
+            log.info(
+                "Access denied (sampled): mode=%s project_id=%s required=%s current=%s",
+                mode, project_id, required, sorted(current_permissions),
+            )
+        #
+        return result
+
     def access_denied_reply(self):
         """ Traefik/client: bad auth reply/redirect """
         if "auth_denied_url" in self.descriptor.config:
@@ -747,11 +1401,11 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
         if auth_data is None:
             auth_data = flask.g.auth
 
-        if not project_id:
-            try:
-                project_id = self.context.rpc_manager.timeout(3).project_get_id()
-            except:  # pylint: disable=W0702
-                project_id = None
+        trace = self._get_trace()
+        if trace is not None:
+            return self._resolve_permissions_traced(trace, mode, auth_data, project_id)
+
+        project_id = self._resolve_project_id(project_id)
 
         # log.info('resolve_permissions mode %s | auth_data %s | project_id %s', mode, auth_data.__dict__, project_id)
         if auth_data.type == "user":
@@ -760,9 +1414,329 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
             return self.get_token_permissions(auth_data.id, mode=mode, project_id=project_id)
         else:
             # Public: no permissions
-            return set()
+            return PermissionSet()
+
+    def _resolve_permissions_traced(self, trace, mode, auth_data, project_id):
+        record = {
+            "call": "resolve_permissions",
+            "mode": mode,
+            "auth": f"{auth_data.type}:{auth_data.id}",
+            "project_id_source": "argument" if project_id else "project_get_id",
+        }
+        started = time.perf_counter()
+        project_id = self._resolve_project_id(project_id)
+        if project_id is None and record["project_id_source"] == "project_get_id":
+            record["project_id_source"] = "none"
+        record["project_id"] = project_id
+        record["project_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        #
+        if auth_data.type in ("user", "token"):
+            cache = self.user_permissions_cache if auth_data.type == "user" \
+                else self.token_permissions_cache
+            with self.permissions_cache_lock:
+                record["cache"] = "hit" if permissions_cache_key(
+                    auth_data.id, mode=mode, project_id=project_id
+                ) in cache else "miss"
+        #
+        started = time.perf_counter()
+        if auth_data.type == "user":
+            result = self.get_user_permissions(auth_data.id, mode=mode, project_id=project_id)
+        elif auth_data.type == "token":
+            result = self.get_token_permissions(auth_data.id, mode=mode, project_id=project_id)
+        else:
+            result = PermissionSet()
+        record["permissions_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        record["permissions_count"] = len(result)
+        #
+        trace.append(record)
+        return result
+
+    def resolve_permissions_all_modes(self, auth_data=None,
+                                      project_id: Optional[int] = None,
+                                      modes: Optional[list] = None) -> dict:
+        """
+        Resolve current permissions for all modes at once: mode -> permissions.
+
+        Tool API for plugins checking several modes for the same user/project.
+        """
+        if auth_data is None:
+            auth_data = flask.g.auth
+        if modes is None:
+            modes = self.permission_modes
+        #
+        project_id = self._resolve_project_id(project_id)
+        #
+        if auth_data.type == "user":
+            getter, cache = self.get_user_permissions, self.user_permissions_cache
+        elif auth_data.type == "token":
+            getter, cache = self.get_token_permissions, self.token_permissions_cache
+        else:
+            return {mode: PermissionSet() for mode in modes}
+        #
+        result = {}
+        missing = []
+        with self.permissions_cache_lock:
+            for mode in modes:
+                key = permissions_cache_key(auth_data.id, mode=mode, project_id=project_id)
+                try:
+                    result[mode] = cache[key]
+                except KeyError:
+                    missing.append(mode)
+        # Cache misses are fetched concurrently, getter fills each mode cache entry
+        futures = {
+            mode: self.rpc_executor.submit(
+                getter, auth_data.id, mode=mode, project_id=project_id
+            )
+            for mode in missing
+        }
+        for mode, future in futures.items():
+            result[mode] = future.result()
+        #
+        return result
+
+    def remember_permissions_version(self, permissions: PermissionSet) -> str:
+        """ Keep permissions by version for diff responses """
+        self.permission_versions[permissions.version] = permissions
+        return permissions.version
+
+    def get_permission_universe(self) -> tuple:
+        """ Registered permissions: (sorted list, permission -> index, version) """
+        universe = self.permission_universe
+        if len(universe[0]) != len(self.local_permissions):
+            ordered = tuple(sorted(self.local_permissions))
+            universe = (
+                ordered,
+                {permission: idx for idx, permission in enumerate(ordered)},
+                permissions_version(ordered),
+            )
+            self.permission_universe = universe
+        return universe
+
+    def _resolve_project_id(self, project_id: Optional[int] = None) -> Optional[int]:
+        if not project_id:
+            try:
+                project_id = self.context.rpc_manager.timeout(3).project_get_id()
+            except:  # pylint: disable=W0702
+                project_id = None
+        return project_id
+
+    #
+    # Tools: caches
+    #
+
+    def _fire_event_after(self, func, event_name, *id_names):
+        """ Wrap mutating proxy: fire event with affected object ID after the call """
+
+        @functools.wraps(func)
+        def _wrapped(*args, **kwargs):
+            result = func(*args, **kwargs)
+            #
+            object_id = args[0] if args else None
+            for name in id_names:
+                if name in kwargs:
+                    object_id = kwargs[name]
+                    break
+            #
+            self.context.event_manager.fire_event(event_name, {"id": object_id})
+            return result
+
+        return _wrapped
+
+    def _fire_tree_event_after(self, func, event_name, op):
+        """ Wrap group/scope add/delete proxy: fire tree change event after the call """
+
+        @functools.wraps(func)
+        def _wrapped(*args, **kwargs):
+            result = func(*args, **kwargs)
+            #
+            change = {"op": op}
+            if op == "add":
+                change["id"] = result if isinstance(result, int) else None
+                if "parent_id" in kwargs:
+                    change["parent_id"] = kwargs["parent_id"]
+            else:
+                change["id"] = kwargs.get("id", args[0] if args else None)
+            #
+            self.context.event_manager.fire_event(event_name, change)
+            return result
+
+        return _wrapped
+
+    def user_in_group(self, user_id, group_id, include_subgroups: bool = True) -> bool:
+        """ Check membership using local group tree index """
+        group_ids = self.get_user_group_ids(user_id)
+        if not include_subgroups:
+            return group_id in group_ids
+        return any(self.group_tree.is_within(item, group_id) for item in group_ids)
+
+    def invalidate_user_groups(self, user_id):
+        """ Drop cached group membership of user """
+        with self.user_cache_lock:
+            self.user_group_ids_cache.pop(user_cache_key(user_id), None)
+
+    def invalidate_user_caches(self, user_id):
+        """ Drop cached data of user """
+        with self.user_cache_lock:
+            self.user_cache.pop(user_cache_key(user_id), None)
+            #
+            for key, value in list(self.user_profile_cache.items()):
+                if value[0] == user_id:
+                    self.user_profile_cache.pop(key, None)
+        #
+        with self.token_cache_lock:
+            for key, value in list(self.token_user_cache.items()):
+                if value["id"] == user_id:
+                    self.token_user_cache.pop(key, None)
+
+    def _indexing_token_expiry(self, func):
+        """ Wrap get_token: remember expiry of every token seen """
+
+        @functools.wraps(func)
+        def _wrapped(*args, **kwargs):
+            token = func(*args, **kwargs)
+            #
+            expires = token.get("expires") if isinstance(token, dict) else None
+            if isinstance(expires, str):
+                try:
+                    expires = datetime.datetime.fromisoformat(expires)
+                except ValueError:
+                    expires = None
+            if isinstance(expires, datetime.datetime):
+                with self.token_state_lock:
+                    self.token_expires[token["id"]] = expires.timestamp()
+                    heapq.heappush(self.token_expiry_heap, (expires.timestamp(), token["id"]))
+            #
+            return token
+
+        return _wrapped
+
+    def token_rejected(self, token_id) -> bool:
+        """ Check local revocation set and expiry index, no RPC """
+        try:
+            if self.token_expiry_heap[0][0] <= time.time():
+                self._prune_token_expiry()
+        except IndexError:  # empty index
+            pass
+        return token_id in self.revoked_tokens
+
+    def _prune_token_expiry(self):
+        # Passed expiries move from the index to the bounded revocation set
+        now = time.time()
+        with self.token_state_lock:
+            heap = self.token_expiry_heap
+            while heap and heap[0][0] <= now:
+                expires, token_id = heapq.heappop(heap)
+                # Skip stale entries: expiry was updated after this one was pushed
+                if self.token_expires.get(token_id) == expires:
+                    del self.token_expires[token_id]
+                    self.revoked_tokens[token_id] = True
+
+    def revoke_token_locally(self, token_id):
+        """ Reject token in this worker and drop its cached data """
+        with self.token_state_lock:
+            self.revoked_tokens[token_id] = True
+            self.token_expires.pop(token_id, None)
+        self.invalidate_token_caches(token_id)
+
+    def invalidate_token_caches(self, token_id):
+        """ Drop cached data of token """
+        with self.token_cache_lock:
+            self.token_user_cache.pop(token_id, None)
+            # get_token is cached by id and by uuid
+            for key, value in list(self.token_cache.items()):
+                if value["id"] == token_id:
+                    self.token_cache.pop(key, None)
 
+    #
+    # Tools: listings
+    #
+
+    def list_page(self, list_name: str, *args, cursor: Optional[str] = None,
+                  limit: int = 100, **kwargs) -> dict:
+        """
+        Page of list_users / list_tokens / list_groups / list_user_groups.
 
+        Listing is fetched and sorted once and kept briefly, so walking pages
+        with cursor costs one RPC. Items returned are copies. Raises ValueError
+        on bad cursor.
+
+        :return: {"items": [...], "next_cursor": str or None}
+        """
+        if list_name not in self.paged_listings:
+            raise ValueError(f"Listing '{list_name}' is not paged")
+        #
+        cache_key = (list_name, args, tuple(sorted(kwargs.items())))
+        with self.listing_cache_lock:
+            items = self.listing_cache.get(cache_key)
+        # First page always gets fresh data, sorted once for all pages
+        if items is None or cursor is None:
+            items = sorted(getattr(self, list_name)(*args, **kwargs), key=lambda item: item["id"])
+            with self.listing_cache_lock:
+                self.listing_cache[cache_key] = items
+        #
+        page, next_cursor = paginate(items, cursor=cursor, limit=limit)
+        return {"items": page, "next_cursor": next_cursor}
+
+    #
+    # Tools: trace
+    #
+
+    def _get_trace(self):
+        if not self.trace_enabled or not flask.has_request_context():
+            return None
+        return flask.g.get("auth_trace", None)
+
+    def _trace_access(self, check, current_permissions, permissions, allowed):
+        trace = self._get_trace()
+        if trace is None:
+            return
+        #
+        required = required_permissions_list(permissions)
+        if not isinstance(current_permissions, PermissionSet):
+            current_permissions = PermissionSet(current_permissions)
+        trace.append({
+            "call": check,
+            "allowed": allowed,
+            "matched": next(
+                (item for item in required if current_permissions.allows(item)), None
+            ),
+            "required": required[:20],
+            "unregistered": [
+                item for item in required if item not in self.local_permissions
+            ][:20],
+        })
+
+    @staticmethod
+    def _before_trace_stage(always, secret):
+        if always or (secret and hmac.compare_digest(
+                flask.request.headers.get("X-Auth-Trace", "").encode(),
+                str(secret).encode(),
+        )):
+            flask.g.auth_trace = []
+
+    def _after_trace_stage(self, response):
+        trace = flask.g.get("auth_trace", None)
+        if trace is not None:
+            self.permission_traces.append(
+                {"method": flask.request.method, "path": flask.request.path, "trace": trace}
+            )
+            # Header stays valid JSON: drop whole trailing records until it fits
+            records = [
+                json.dumps(record, default=str, separators=(",", ":")) for record in trace
+            ]
+            size = sum(len(item) + 1 for item in records) + 1
+            dropped = 0
+            while records and size > 4096:
+                size -= len(records.pop()) + 1
+                dropped += 1
+            if dropped:
+                response.headers["X-Auth-Trace-Truncated"] = str(dropped)
+            response.headers["X-Auth-Trace"] = "[" + ",".join(records) + "]"
+        return response
+
+    def get_permission_traces(self) -> list:
+        """ Recent permission traces, newest last """
+        return list(self.permission_traces)
 
     #
     # Tools: SIO
@@ -790,8 +1764,7 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
                 "target": "rpc",
                 "scope": None,
             }
-            headers = dict(req.headers.items())
-            cookies = dict(req.cookies.items())
+            headers, cookies = self.trim_authorize_credentials(req.headers, req.cookies)
             # Call authorize RPC
             try:
                 auth_status = self.context.rpc_manager.timeout(5).auth_authorize(
@@ -839,8 +1812,51 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
     # Tools: slot
     #
 
+    def slot_access(self, auth_data=None) -> list:
+        """ Slot requirements evaluated in one batch per render: requirement id -> allowed """
+        if auth_data is None:
+            auth_data = flask.g.auth
+        #
+        render = flask.g.get("auth_slot_render", None)
+        if render is None:
+            render = Holder()
+            try:
+                render.mode = flask.g.theme.active_mode
+            except AttributeError:
+                render.mode = c.DEFAULT_MODE
+            render.batches = {}  # (auth type, auth id) -> (permissions, results)
+            flask.g.auth_slot_render = render
+        #
+        key = (auth_data.type, auth_data.id)
+        if key not in render.batches:
+            render.batches[key] = (
+                self.resolve_permissions(mode=render.mode, auth_data=auth_data), []
+            )
+        current_permissions, results = render.batches[key]
+        # Slots registered after the batch was made are evaluated on demand
+        if len(results) < len(self.slot_requirements):
+            results.extend(
+                has_access(current_permissions, permissions)
+                for permissions in self.slot_requirements[len(results):]
+            )
+            log.debug("from check_slot %s %s %s", render.mode, current_permissions, results)
+            trace = self._get_trace()
+            if trace is not None:
+                trace.append({
+                    "call": "check_slot",
+                    "mode": render.mode,
+                    "allowed": results.count(True),
+                    "denied": [idx for idx, value in enumerate(results) if not value],
+                })
+        #
+        return results
+
     def make_request_state(self):
-        """ Make request state snapshot for slots """
+        """ Make request state snapshot for slots, once per request """
+        state = flask.g.get("auth_request_state", None)
+        if state is not None:
+            return state
+        #
         state = Holder()
         #
         state.auth = flask.g.auth
@@ -854,4 +1870,5 @@ class Module(module.ModuleModel):  # pylint: disable=R0902
         state.theme.active_section = flask.g.theme.active_section
         state.theme.active_subsection = flask.g.theme.active_subsection
         #
+        flask.g.auth_request_state = state
         return state
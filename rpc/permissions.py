@@ -0,0 +1,26 @@
+from pylon.core.tools import web, log
+
+
+class RPC:
+    @web.rpc('auth_main_resolve_permissions_bulk', 'resolve_permissions_bulk')
+    def resolve_permissions_bulk(self, pairs: list, mode: str = 'administration') -> list:
+        """ Resolve permissions for many (user_id, project_id) pairs at once """
+        pairs = list(dict.fromkeys(
+            (user_id, project_id) for user_id, project_id in pairs
+        ))
+        if len(pairs) > self.bulk_limit:
+            raise ValueError(f"At most {self.bulk_limit} pairs are allowed")
+        futures = [
+            self.bulk_executor.submit(
+                self.get_user_permissions, user_id, mode=mode, project_id=project_id
+            )
+            for user_id, project_id in pairs
+        ]
+        return [
+            {
+                "user_id": user_id,
+                "project_id": project_id,
+                "permissions": sorted(future.result()),
+            }
+            for (user_id, project_id), future in zip(pairs, futures)
+        ]
@@ -17,8 +17,7 @@ class RPC:
             auth_data.user = user_data
             return user_data
         elif auth_data.type == "token":
-            token = self.get_token(auth_data.id)
-            user_data = self.get_user(token["user_id"])
+            user_data = self.get_token_user(auth_data.id)
             auth_data.user = user_data
             return user_data
         else:
@@ -26,3 +25,53 @@ class RPC:
             return {
                 "id": None, "email": "public@platform.user", "name": "Public"
             }
+
+    @web.rpc('auth_main_get_token_user', 'get_token_user')
+    def get_token_user(self, token_id: int) -> dict:
+        """ Get user owning the token, cached by token ID """
+        with self.token_cache_lock:
+            user_data = self.token_user_cache.get(token_id)
+        if user_data is not None:
+            return user_data
+
+        token = self.get_token(token_id)
+        user_data = self.get_user(token["user_id"])
+        with self.token_cache_lock:
+            self.token_user_cache[token_id] = user_data
+        return user_data
+
+    @web.rpc('auth_main_get_token_users', 'get_token_users')
+    def get_token_users(self, token_ids: list) -> dict:
+        """ Get users owning the tokens: token_id -> user, None for missing tokens """
+        result = {}
+        with self.token_cache_lock:
+            for token_id in token_ids:
+                user_data = self.token_user_cache.get(token_id)
+                if user_data is not None:
+                    result[token_id] = user_data
+        missing = [token_id for token_id in dict.fromkeys(token_ids) if token_id not in result]
+        if not missing:
+            return result
+
+        token_futures = {
+            token_id: self.bulk_executor.submit(self.get_token, token_id)
+            for token_id in missing
+        }
+        token_owners = {}
+        for token_id, future in token_futures.items():
+            try:
+                token_owners[token_id] = future.result()["user_id"]
+            except RuntimeError:  # deleted token
+                result[token_id] = None
+        # Each owner is fetched once, however many tokens they have
+        user_futures = {
+            user_id: self.bulk_executor.submit(self.get_user, user_id)
+            for user_id in set(token_owners.values())
+        }
+        users = {user_id: future.result() for user_id, future in user_futures.items()}
+
+        with self.token_cache_lock:
+            for token_id, user_id in token_owners.items():
+                self.token_user_cache[token_id] = users[user_id]
+                result[token_id] = users[user_id]
+        return result
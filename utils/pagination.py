@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# coding=utf-8
+
+#   Copyright 2022 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+""" Cursor pagination """
+
+import json
+import base64
+import bisect
+from typing import Optional
+
+
+def encode_cursor(value) -> str:
+    """ Make opaque cursor from last seen key """
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """ Get last seen key from cursor, ValueError on bad cursor """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception as exc:  # pylint: disable=W0703
+        raise ValueError(f"Bad cursor: {cursor}") from exc
+    # Keys are integer IDs, anything else would fail in bisect
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(f"Bad cursor: {cursor}")
+    return value
+
+
+def paginate(ordered: list, cursor: Optional[str] = None, limit: int = 100,
+             key: str = "id") -> tuple:
+    """
+    Page of items after cursor: (page, next cursor or None).
+
+    Items must be sorted by key already, page items are copies.
+    """
+    start = 0
+    if cursor:
+        # Cursor key may be gone after deletes, continue from the next one
+        start = bisect.bisect_right(
+            ordered, decode_cursor(cursor), key=lambda item: item[key]
+        )
+    #
+    page = [dict(item) for item in ordered[start:start + limit]]
+    next_cursor = None
+    if start + limit < len(ordered) and page:
+        next_cursor = encode_cursor(page[-1][key])
+    #
+    return page, next_cursor
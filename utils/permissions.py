@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# coding=utf-8
+
+#   Copyright 2022 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+""" Permission sets with wildcard grants """
+
+import hashlib
+import functools
+
+
+WILDCARD = "*"
+_TERMINAL = None
+
+
+class PermissionTrie:
+    """
+    Trie of wildcard grants.
+
+    '*' matches exactly one segment, trailing '*' matches one or more:
+    'models.*.view' grants 'models.x.view', 'configuration.*' grants
+    everything below 'configuration'.
+    """
+
+    __slots__ = ("root",)
+
+    def __init__(self, grants=()):
+        self.root = {}
+        for grant in grants:
+            self.add(grant)
+
+    def __bool__(self):
+        return bool(self.root)
+
+    def add(self, grant: str):
+        """ Add grant """
+        node = self.root
+        for part in grant.split("."):
+            node = node.setdefault(part, {})
+        node[_TERMINAL] = True
+
+    def matches(self, permission: str) -> bool:
+        """ Check if permission is covered by any grant """
+        return self._match(self.root, permission.split("."), 0)
+
+    def _match(self, node: dict, parts: list, idx: int) -> bool:
+        if idx == len(parts):
+            return _TERMINAL in node
+        #
+        child = node.get(parts[idx])
+        if child is not None and self._match(child, parts, idx + 1):
+            return True
+        #
+        child = node.get(WILDCARD)
+        if child is not None:
+            if _TERMINAL in child:
+                return True
+            return self._match(child, parts, idx + 1)
+        #
+        return False
+
+
+class PermissionSet(frozenset):
+    """ Resolved permissions: exact grants plus lazily built wildcard trie """
+
+    def __new__(cls, permissions=()):
+        obj = super().__new__(cls, permissions)
+        obj._trie = None
+        obj._version = None
+        return obj
+
+    @property
+    def version(self) -> str:
+        """ Stable hash of permissions, computed on first use """
+        if self._version is None:
+            self._version = permissions_version(self)
+        return self._version
+
+    @property
+    def trie(self) -> PermissionTrie:
+        """ Wildcard grants trie, built on first use """
+        if self._trie is None:
+            self._trie = PermissionTrie(
+                permission for permission in self if WILDCARD in permission
+            )
+        return self._trie
+
+    def allows(self, permission: str) -> bool:
+        """ Check single required permission: O(1) exact, O(depth) wildcard """
+        if permission in self:
+            return True
+        trie = self.trie
+        return bool(trie) and trie.matches(permission)
+
+
+def permissions_version(permissions) -> str:
+    """ Stable hash of permission strings, independent of order """
+    return hashlib.sha1("\n".join(sorted(permissions)).encode()).hexdigest()[:16]
+
+
+def returns_permission_set(func):
+    """ Wrap permissions getter to return PermissionSet """
+
+    @functools.wraps(func)
+    def _wrapped(*args, **kwargs):
+        return PermissionSet(func(*args, **kwargs))
+
+    return _wrapped
+
+
+def permissions_cache_key(auth_id, mode=None, project_id=None):
+    """ Cache key for user/token permissions, same for positional and keyword calls """
+    return auth_id, mode, project_id
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# coding=utf-8
+
+#   Copyright 2022 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+""" In-process rate limiting """
+
+import math
+import time
+import threading
+
+
+class RateLimiter:  # pylint: disable=R0902
+    """
+    Token buckets per key, idle state expired with a time wheel.
+
+    Bucket idle for burst / rate seconds is full again, same as no state,
+    so it is dropped when its wheel slot comes round.
+    """
+
+    def __init__(self, rate: float, burst: float, wheel_size: int = 64):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.lock = threading.Lock()
+        #
+        self.buckets = {}  # key -> [tokens, last time, tick]
+        self.wheel = [set() for _ in range(wheel_size)]
+        self.tick_seconds = max(self.burst / self.rate, 1.0) / wheel_size
+        self.tick = None
+
+    def allow(self, key, now=None) -> float:
+        """ Take one token: 0 when allowed, else seconds to retry after """
+        if now is None:
+            now = time.monotonic()
+        tick = int(now / self.tick_seconds)
+        #
+        with self.lock:
+            self._advance(tick)
+            #
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now, tick]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                if bucket[2] != tick:
+                    self.wheel[bucket[2] % len(self.wheel)].discard(key)
+                    bucket[2] = tick
+            self.wheel[tick % len(self.wheel)].add(key)
+            #
+            if bucket[0] >= 1.0:
+                bucket[0] -= 1.0
+                return 0
+            return (1.0 - bucket[0]) / self.rate
+
+    def _advance(self, tick: int):
+        if self.tick is None:
+            self.tick = tick
+            return
+        # Each slot passed holds keys untouched for a full wheel turn
+        for passed in range(self.tick + 1, min(tick, self.tick + len(self.wheel)) + 1):
+            slot = self.wheel[passed % len(self.wheel)]
+            for key in slot:
+                if self.buckets.get(key, (None, None, passed))[2] < passed:
+                    self.buckets.pop(key, None)
+            slot.clear()
+        if tick - self.tick > len(self.wheel):
+            for slot in self.wheel:
+                slot.clear()
+            self.buckets.clear()
+        self.tick = max(self.tick, tick)
+
+
+def retry_after_header(seconds: float) -> str:
+    """ Retry-After value, whole seconds """
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+# coding=utf-8
+
+#   Copyright 2022 getcarrier.io
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+""" Local tree index (groups, scopes) """
+
+import time
+import threading
+
+
+class TreeIndex:
+    """
+    Closure table of a forest: node -> all ancestors.
+
+    Loaded on first query with loader() returning [{"id", "parent_id"}],
+    then kept current with apply_change(). Unknown changes mark index stale,
+    next query reloads it. Reloaded every ttl seconds to pick up changes made
+    outside this process.
+    """
+
+    def __init__(self, loader, ttl=60):
+        self.loader = loader
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.loaded_at = 0.0
+        self.parents = {}  # node -> parent or None
+        self.children = {}  # node -> set of children
+        self.ancestors = {}  # node -> frozenset of ancestors
+
+    def _fresh(self) -> bool:
+        return self.loaded and time.monotonic() - self.loaded_at < self.ttl
+
+    def _ensure_loaded(self):
+        if self._fresh():
+            return
+        with self.lock:
+            if self._fresh():
+                return
+            self.parents.clear()
+            self.children.clear()
+            self.ancestors.clear()
+            #
+            pending = {item["id"]: item.get("parent_id") for item in self.loader()}
+            # Parents first, input order is not guaranteed
+            while pending:
+                ready = [
+                    node for node, parent in pending.items()
+                    if parent is None or parent not in pending
+                ]
+                if not ready:  # cycle: attach the rest as roots
+                    ready = list(pending)
+                    for node in ready:
+                        pending[node] = None
+                for node in ready:
+                    self._add(node, pending.pop(node))
+            #
+            self.loaded = True
+            self.loaded_at = time.monotonic()
+
+    def _add(self, node, parent):
+        if parent is not None and parent not in self.parents:
+            parent = None
+        self.parents[node] = parent
+        self.children.setdefault(node, set())
+        if parent is None:
+            self.ancestors[node] = frozenset()
+        else:
+            self.children[parent].add(node)
+            self.ancestors[node] = self.ancestors[parent] | {parent}
+
+    def _remove(self, node):
+        if node not in self.parents:
+            return
+        parent = self.parents[node]
+        if parent is not None:
+            self.children[parent].discard(node)
+        for item in [node] + list(self._descendants(node)):
+            self.parents.pop(item, None)
+            self.children.pop(item, None)
+            self.ancestors.pop(item, None)
+
+    def _descendants(self, node) -> set:
+        result = set()
+        stack = list(self.children.get(node, ()))
+        while stack:
+            item = stack.pop()
+            result.add(item)
+            stack.extend(self.children.get(item, ()))
+        return result
+
+    def apply_change(self, change: dict):
+        """ Apply {"op": "add"/"delete", "id", "parent_id"} change """
+        with self.lock:
+            if not self.loaded:
+                return
+            if change.get("op") == "delete" and change.get("id") is not None:
+                self._remove(change["id"])
+            elif change.get("op") == "add" and change.get("id") is not None \
+                    and "parent_id" in change \
+                    and (change["parent_id"] is None or change["parent_id"] in self.parents):
+                self._add(change["id"], change["parent_id"])
+            else:
+                self.loaded = False
+
+    def invalidate(self):
+        """ Reload on next query """
+        self.loaded = False
+
+    def get_ancestors(self, node) -> frozenset:
+        """ All ancestors of node """
+        self._ensure_loaded()
+        return self.ancestors.get(node, frozenset())
+
+    def get_descendants(self, node) -> set:
+        """ All descendants of node """
+        self._ensure_loaded()
+        with self.lock:
+            return self._descendants(node)
+
+    def is_ancestor(self, ancestor, node) -> bool:
+        """ Check if ancestor is above node """
+        self._ensure_loaded()
+        return ancestor in self.ancestors.get(node, ())
+
+    def is_within(self, node, root) -> bool:
+        """ Check if node is root or below it """
+        return node == root or self.is_ancestor(root, node)